@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Local control socket to tune running healers.
+
+The server listens on a unix socket and accepts one command per line.
+Each command gets a one line JSON reply::
+
+    list                          healers state and parameters
+    set <healer> <param> <value>  change a healer parameter
+    pause <healer>                stop checking notifications
+    resume <healer>               resume checking notifications
+    drain <healer>                check pending notifications now
+    reload [<healer>]             reload healers configuration
+    audit <healer>                run the healer audit, if any
+
+For example::
+
+    echo "set fip-healer buffer_size 50" | socat - UNIX-CONNECT:/run/contrail-healer.sock
+"""
+from __future__ import unicode_literals
+
+import os
+import json
+import logging
+
+from gevent import socket
+from gevent.server import StreamServer
+
+from contrail_api_cli.exceptions import CommandError
+
+
+logger = logging.getLogger(__name__)
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlServer(object):
+
+    def __init__(self, path, healers):
+        """
+        :param path: unix socket path
+        :type path: str
+        :param healers: running healers by name
+        :type healers: dict
+        """
+        self.path = path
+        self.healers = healers
+        self._server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(5)
+        self._server = StreamServer(listener, self._handle)
+        self._server.start()
+        logger.info("Control socket listening on %s" % self.path)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _handle(self, sock, address):
+        f = sock.makefile('rw')
+        try:
+            for line in f:
+                f.write(json.dumps(self.execute(line)) + '\n')
+                f.flush()
+        finally:
+            f.close()
+            sock.close()
+
+    def execute(self, line):
+        """Run a control command.
+
+        :param line: command line
+        :type line: str
+        :rtype: dict
+        """
+        args = line.split()
+        if not args:
+            return {'error': 'No command'}
+        cmd, args = args[0], args[1:]
+        method = getattr(self, 'do_%s' % cmd, None)
+        if method is None:
+            return {'error': 'Unknown command %s' % cmd}
+        try:
+            return {'result': method(*args)}
+        except TypeError:
+            return {'error': 'Wrong arguments for %s' % cmd}
+        except (ControlError, CommandError, ValueError) as e:
+            return {'error': str(e)}
+
+    def _get_healer(self, name):
+        try:
+            return self.healers[name]
+        except KeyError:
+            raise ControlError('Unknown healer %s' % name)
+
+    def do_list(self):
+        return dict((name, dict(h.params, paused=h.paused,
+                                buffered=h._buffer.qsize(),
+                                queued=h.queue.qsize(),
+                                window=h.window,
+                                executor=h.executor))
+                    for name, h in self.healers.items())
+
+    def do_set(self, name, param, value):
+        healer = self._get_healer(name)
+        healer.set_param(param, value)
+        return healer.params
+
+    def do_pause(self, name):
+        self._get_healer(name).pause()
+
+    def do_resume(self, name):
+        self._get_healer(name).resume()
+
+    def do_drain(self, name):
+        self._get_healer(name).drain()
+
+    def do_audit(self, name):
+        healer = self._get_healer(name)
+        if not hasattr(healer, 'audit'):
+            raise ControlError('Healer %s has no audit' % name)
+        return healer.audit()
+
+    def do_reload(self, name=None):
+        if name is None:
+            healers = self.healers.values()
+        else:
+            healers = [self._get_healer(name)]
+        for healer in healers:
+            if healer.config_file is not None:
+                healer.reload_config()
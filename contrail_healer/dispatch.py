@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Notifications dispatch table.
+
+Healers are indexed by resource type and operation. Healers can also
+declare predicates on the notification fields with the `where` attribute
+and be bound to a notifications source with the `source` attribute.
+Predicates that compare a field with a value are indexed with a hash
+table so that a notification is only matched against healers that can
+accept it. Predicates that are callables are evaluated afterwards.
+"""
+from __future__ import unicode_literals
+
+
+ANY = '*'
+"""Wildcard resource type"""
+
+MISSING = object()
+
+
+def get_field(body, field):
+    """Get a field value from a notification.
+
+    :param body: notification
+    :type body: dict
+    :param field: dotted path of the field (eg: `obj_dict.fq_name`)
+    :type field: str
+    """
+    value = body
+    for key in field.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+class Route(object):
+
+    def __init__(self):
+        # healers without value predicates
+        self.unconditional = []
+        # field -> value -> healers
+        self.indexes = {}
+
+    def add(self, healer, where):
+        values = sorted((f, v) for f, v in where.items() if not callable(v))
+        callables = [(f, v) for f, v in where.items() if callable(v)]
+        if not values:
+            self.unconditional.append((healer, callables))
+            return
+        # index on the first value predicate, check the others later
+        (field, value), values = values[0], values[1:]
+        entry = (healer, values + callables)
+        self.indexes.setdefault(field, {}).setdefault(_hashable(value), []).append(entry)
+
+    def candidates(self, body):
+        for entry in self.unconditional:
+            yield entry
+        for field, index in self.indexes.items():
+            value = get_field(body, field)
+            if value is MISSING:
+                continue
+            try:
+                entries = index.get(_hashable(value), [])
+            except TypeError:
+                continue
+            for entry in entries:
+                yield entry
+
+
+class DispatchTable(object):
+
+    def __init__(self):
+        # (resource type, oper) -> Route
+        self._routes = {}
+        self._opers = set()
+
+    def add(self, healer):
+        """Register a healer.
+
+        :type healer: :class:`contrail_healer.healer.Healer`
+        """
+        where = dict(getattr(healer, 'where', None) or {})
+        if getattr(healer, 'source', None) is not None:
+            where['source'] = healer.source
+        for oper in healer.on:
+            key = (healer.resource, oper)
+            self._opers.add(oper)
+            if key not in self._routes:
+                self._routes[key] = Route()
+            self._routes[key].add(healer, where)
+
+    def has_oper(self, oper):
+        """Tell if some healer is registered for an operation.
+        """
+        return oper in self._opers
+
+    def has_route(self, resource, oper):
+        """Tell if some healer is registered for a resource type and
+        an operation.
+        """
+        return (resource, oper) in self._routes or (ANY, oper) in self._routes
+
+    def match(self, body):
+        """Return healers that accept the notification.
+
+        :param body: notification
+        :type body: dict
+        :rtype: [Healer]
+        """
+        try:
+            resource = body['type']
+            oper = body['oper']
+        except (KeyError, TypeError):
+            return []
+        healers = []
+        for key in ((resource, oper), (ANY, oper)):
+            route = self._routes.get(key)
+            if route is None:
+                continue
+            for healer, predicates in route.candidates(body):
+                if healer in healers:
+                    continue
+                if all(self._check(body, f, p) for f, p in predicates):
+                    healers.append(healer)
+        return healers
+
+    def _check(self, body, field, predicate):
+        value = get_field(body, field)
+        if callable(predicate):
+            return predicate(None if value is MISSING else value)
+        return value is not MISSING and _hashable(value) == _hashable(predicate)
@@ -2,27 +2,149 @@
 from __future__ import unicode_literals
 
 import os
+import re
+import signal
 import socket
 import logging
 
+import gevent
 from kombu import Connection, Exchange, Queue, Consumer
+from stevedore.extension import ExtensionManager
+from stevedore.named import NamedExtensionManager
+from kazoo.exceptions import KazooException
 
-from contrail_api_cli.manager import CommandManager
 from contrail_api_cli.command import Command, Option
 from contrail_api_cli.resource import Resource
 from contrail_api_cli.exceptions import CommandError
 
 from .pool import Pool
+from .registry import Registry, ZkConnectionError
+from .control import ControlServer
+from .dispatch import DispatchTable
+
+try:
+    from gevent import signal_handler
+except ImportError:
+    from gevent import signal as signal_handler
+try:
+    import ujson as json
+except ImportError:
+    import json
 
 VNC_EXCHANGE = 'vnc_config.object-update'
+HEALER_NS = 'contrail_api_cli.healer'
+HEALER_MAX_RETRY_DELAY = 60
+SOURCE_MAX_RETRY_DELAY = 60
+# healer initialization errors that can go away
+HEALER_RETRY_ERRORS = (IOError, KazooException, ZkConnectionError, gevent.Timeout)
+# used to find notifications that can be routed to healers
+# without decoding the whole notification
+PEEK_TYPE = re.compile(br'"type"\s*:\s*"([^"]+)"')
+PEEK_OPER = re.compile(br'"oper"\s*:\s*"(CREATE|UPDATE|DELETE)"')
 logger = logging.getLogger(__name__)
 pool = Pool()
+registry = Registry()
 
 
 class ConnectionLost(Exception):
     pass
 
 
+class Source(object):
+    """RabbitMQ broker notifications are consumed from.
+
+    A source can have several nodes, kombu fails over between them.
+    """
+
+    def __init__(self, name, urls, vhost, on_message):
+        """
+        :param name: name used to tag notifications from this source
+        :type name: str
+        :param urls: nodes urls (user:pass@server:port)
+        :type urls: [str]
+        :param vhost: RabbitMQ vhost
+        :type vhost: str
+        :param on_message: called with each message and the source
+        """
+        self.name = name
+        self.urls = ["amqp://%s/%s" % (url, vhost) for url in urls]
+        self.on_message = on_message
+        self.conn = None
+        self.consumer = None
+        # errors that require a reconnection, completed with the
+        # transport errors once connected
+        self.errors = (socket.timeout, socket.error, IOError, ConnectionLost)
+
+    @classmethod
+    def from_option(cls, index, value, vhost, on_message):
+        """Build a source from a `[name=]url[;url...]` option value.
+        """
+        name = 'source-%s' % index
+        if '=' in value:
+            prefix, urls = value.split('=', 1)
+            if not set(':@;') & set(prefix):
+                name, value = prefix, urls
+        return cls(name, value.split(';'), vhost, on_message)
+
+    def connect(self):
+        self.conn = Connection(self.urls, failover_strategy='round-robin')
+        self.errors = (socket.timeout, socket.error, IOError, ConnectionLost) + \
+            self.conn.connection_errors + self.conn.channel_errors
+        try:
+            self.conn.connect()
+        except self.errors:
+            self.conn = None
+            raise ConnectionLost("Failed to connect to RabbitMQ server %s" % self.name)
+
+        exchange = Exchange(VNC_EXCHANGE, 'fanout', durable=False)(self.conn)
+
+        queue = Queue("contrail-healer", exchange,
+                      durable=False, auto_delete=True)(self.conn.channel())
+        queue.declare()
+
+        self.consumer = Consumer(self.conn.channel(),
+                                 queues=[queue],
+                                 on_message=self._on_message)
+        self.consumer.consume()
+
+    def _on_message(self, message):
+        try:
+            self.on_message(message, self)
+        except Exception as e:
+            # a bad notification must not stop the consumption
+            logger.error("Failed to process notification from %s: %s" % (self.name, e))
+            if not message.acknowledged:
+                message.ack()
+
+    def run(self):
+        """Consume notifications, reconnect when the connection is lost.
+        """
+        delay = 1
+        while True:
+            try:
+                if self.conn is None:
+                    self.connect()
+                    delay = 1
+                while True:
+                    self.conn.drain_events()
+            except self.errors as e:
+                logger.info("RabbitMQ server %s unavailable (%s), retrying in %ss" % (self.name, e, delay))
+                self.close()
+                gevent.sleep(delay)
+                delay = min(delay * 2, SOURCE_MAX_RETRY_DELAY)
+
+    def close(self):
+        if self.consumer is not None:
+            try:
+                self.consumer.cancel()
+            except Exception:
+                pass
+            self.consumer = None
+        if self.conn is not None:
+            self.conn.release()
+            self.conn = None
+
+
 class Heal(Command):
     """contrail-api-cli heal command.
 
@@ -39,63 +161,174 @@ class Heal(Command):
 
     The url and vhost can also be sourced from the environment variables
     `$CONTRAIL_HEALER_RABBIT_URL` and `$CONTRAIL_HEALER_RABBIT_VHOST`.
+
+    Notifications can be consumed from several brokers at once by giving
+    several urls, separated by spaces in the environment variable. Nodes
+    of a RabbitMQ cluster are separated by `;` and a source can be named
+    with a `name=` prefix. One vhost can be given for all the sources or
+    one per source::
+
+        contrail-api-cli heal --rabbit-url "dc1=u:p@rmq1a:5672;u:p@rmq1b:5672" dc2=u:p@rmq2:5672 --rabbit-vhost opencontrail
+
+    Each source connects and reconnects on its own, a source unreachable
+    at startup doesn't prevent the others from being consumed. The source
+    name is added in the `source` field of the notifications. Healers get
+    the notifications of all the sources unless they are bound to one of
+    them with their `source` attribute or configuration option (see
+    :class:`contrail_healer.healer.Healer`).
+
+    ZooKeeper clients and contrail-api connections are shared between
+    healers through :class:`contrail_healer.registry.Registry`. The number
+    of keep-alive connections to contrail-api can be raised with
+    `--api-pool-size`.
+
+    Healers are initialized concurrently in the background while the
+    notifications are consumed. Only the healers listed with `--healers`
+    (or in `$CONTRAIL_HEALER_HEALERS`, comma separated) are loaded, all
+    healers are loaded by default. A healer that fails to initialize
+    within `--healer-timeout` seconds or because of a network error is
+    retried with an increasing delay, other errors are only reported.
+
+    Healers parameters can be changed at runtime through a local control
+    socket enabled with `--control-socket` (see :mod:`contrail_healer.control`).
+    On SIGHUP the healers configuration files are reloaded.
+
+    JSON notifications are fully decoded only if they can be routed to a
+    healer. `ujson` is used to decode them if available. Other content
+    types are decoded by kombu.
     """
-    rabbit_url = Option(default=os.environ.get('CONTRAIL_HEALER_RABBIT_URL'))
-    rabbit_vhost = Option(default=os.environ.get('CONTRAIL_HEALER_RABBIT_VHOST'))
+    rabbit_url = Option(nargs='+',
+                        default=os.environ.get('CONTRAIL_HEALER_RABBIT_URL', '').split())
+    rabbit_vhost = Option(nargs='+',
+                          default=os.environ.get('CONTRAIL_HEALER_RABBIT_VHOST', '').split())
+    api_pool_size = Option(type=int, default=Registry.api_pool_size,
+                           help="Min keep-alive connections to contrail-api (default: contrail-api-cli pool)")
+    healers = Option(nargs='*', metavar='HEALER',
+                     default=[h for h in os.environ.get('CONTRAIL_HEALER_HEALERS', '').split(',') if h],
+                     help="Healers to load (default: all)")
+    healer_timeout = Option(type=int, default=30,
+                            help="Healer initialization timeout in seconds (default: %(default)s)")
+    control_socket = Option(default=os.environ.get('CONTRAIL_HEALER_CONTROL_SOCKET'),
+                            help="Unix socket path for runtime control (default: disabled)")
+
+    def __call__(self, rabbit_url=None, rabbit_vhost=None,
+                 api_pool_size=Registry.api_pool_size,
+                 healers=None, healer_timeout=30, control_socket=None):
+        self.rabbit_url = rabbit_url or []
+        self.rabbit_vhost = rabbit_vhost or []
+        self.healer_names = healers
+        self.healer_timeout = healer_timeout
+        self._dispatch = DispatchTable()
+        self._healers_by_name = {}
 
-    def __call__(self, rabbit_url=None, rabbit_vhost=None):
-        self.rabbit_url = rabbit_url
-        self.rabbit_vhost = rabbit_vhost
-        self._healers = {}
+        self.control = None
+        if control_socket is not None:
+            self.control = ControlServer(control_socket, self._healers_by_name)
+            self.control.start()
+        signal_handler(signal.SIGHUP, self._reload)
+
+        registry.api_pool_size = api_pool_size
+        registry.api_session()
 
         self._setup()
         self._register_healers()
-        self._start_healers()
         self._start()
 
     def _setup(self):
-        self.conn = Connection("amqp://%s/%s" % (self.rabbit_url, self.rabbit_vhost))
-        try:
-            self.conn.connect()
-        except (socket.timeout, socket.error, IOError):
-            raise CommandError("Failed to connect to RabbitMQ server")
-
-        exchange = Exchange(VNC_EXCHANGE, 'fanout', durable=False)(self.conn)
-
-        self.queue = Queue("contrail-healer", exchange,
-                           durable=False, auto_delete=True)(self.conn.channel())
-        self.queue.declare()
-
-        self.consumer = Consumer(self.conn.channel(),
-                                 queues=[self.queue],
-                                 callbacks=[self._process])
+        if not self.rabbit_url:
+            raise CommandError("No RabbitMQ server provided")
+        if len(self.rabbit_vhost) not in (1, len(self.rabbit_url)):
+            raise CommandError("Provide one vhost or one vhost per RabbitMQ server")
+        vhosts = self.rabbit_vhost * len(self.rabbit_url) if len(self.rabbit_vhost) == 1 else self.rabbit_vhost
+        # sources connect when started and retry on their own
+        self.sources = [Source.from_option(index, url, vhost, self._on_message)
+                        for index, (url, vhost) in enumerate(zip(self.rabbit_url, vhosts))]
+        registry.sources = [source.name for source in self.sources]
 
     def _start(self):
-        self.consumer.consume()
+        greenlets = []
+        for source in self.sources:
+            g = pool.spawn(source.run)
+            g.link_exception(self._on_source_stopped(source))
+            greenlets.append(g)
         try:
-            while True:
-                self.conn.drain_events()
-        except IOError:
-            logger.info("Disconnected from RabbitMQ server, reconnecting")
-            self._setup()
-            self._start()
+            gevent.joinall(greenlets)
         except KeyboardInterrupt:
             self._cleanup()
             raise
+        # sources only stop on unexpected errors
+        self._cleanup()
+        raise CommandError("All RabbitMQ sources stopped")
+
+    def _on_source_stopped(self, source):
+        def log(g):
+            logger.error("Stopped consuming %s: %s" % (source.name, g.exception))
+        return log
 
     def _cleanup(self):
         logger.debug("Doing some cleanup...")
-        self.consumer.cancel()
+        for source in self.sources:
+            source.close()
+        if self.control is not None:
+            self.control.stop()
         pool.kill()
+        logger.info("Connection pools: %s" % registry.stats())
+        registry.close()
 
-    def _process(self, body, message):
+    def _on_message(self, message, source):
+        if message.content_type != 'application/json' or \
+                message.content_encoding not in ('utf-8', 'utf8') or \
+                message.headers.get('compression') is not None:
+            # let kombu decode the message
+            try:
+                body = message.decode()
+            except Exception as e:
+                logger.error("Failed to decode notification: %s" % e)
+                message.ack()
+                return
+            self._process(body, message, source)
+            return
+        raw = message.body
+        if not isinstance(raw, bytes):
+            raw = raw.encode('utf-8')
+        if not self._is_routed(raw):
+            message.ack()
+            return
         try:
-            resource = body['type']
-            oper = body['oper']
-        except KeyError:
-            pass
-        else:
-            healers = self._healers.get(resource, {}).get(oper, [])
+            body = json.loads(raw.decode('utf-8'))
+        except ValueError:
+            logger.error("Failed to decode notification")
+            message.ack()
+            return
+        self._process(body, message, source)
+
+    def _is_routed(self, raw):
+        """Tell if a raw JSON notification can be routed to a healer.
+
+        Only the first `oper` field with an operation value is read, it
+        is assumed to be the notification one. Notifications whose
+        operation is not handled by any healer are dropped after this
+        single search. Otherwise `type` fields are searched until a
+        routed type is found.
+
+        Nested `type` fields can give false positives, they are dropped
+        by the dispatch table once the notification is decoded.
+        """
+        match = PEEK_OPER.search(raw)
+        if match is None:
+            return False
+        oper = match.group(1).decode('ascii')
+        if not self._dispatch.has_oper(oper):
+            return False
+        for match in PEEK_TYPE.finditer(raw):
+            if self._dispatch.has_route(match.group(1).decode('utf-8'), oper):
+                return True
+        return False
+
+    def _process(self, body, message, source):
+        try:
+            body['source'] = source.name
+            healers = self._dispatch.match(body)
             if healers:
                 pool.spawn(self._broadcast, healers, body)
         finally:
@@ -114,25 +347,56 @@ class Heal(Command):
             h.queue.put((body['oper'], resource))
 
     def _register_healers(self):
-        ns = 'contrail_api_cli.healer'
-        manager = CommandManager()
-        manager.load_namespace(ns)
-        for mgr in manager.mgrs:
-            if mgr.namespace == ns:
-                for ext in mgr.extensions:
-                    if ext.obj is not None:
-                        self._register_healer(ext.obj)
+        if self.healer_names:
+            mgr = NamedExtensionManager(HEALER_NS, self.healer_names,
+                                        on_load_failure_callback=self._on_load_failure,
+                                        on_missing_entrypoints_callback=self._on_missing_healers)
+        else:
+            mgr = ExtensionManager(HEALER_NS,
+                                   on_load_failure_callback=self._on_load_failure)
+        for ext in mgr.extensions:
+            pool.spawn(self._init_healer, ext.name, ext.plugin)
+
+    def _on_load_failure(self, mgr, entrypoint, exc):
+        logger.error("Cannot load healer %s: %s" % (entrypoint.name, exc))
+
+    def _on_missing_healers(self, names):
+        logger.error("Unknown healers: %s" % ", ".join(sorted(names)))
+
+    def _init_healer(self, name, plugin):
+        """Instantiate, register and start a healer.
+
+        The initialization is retried until it succeeds if it fails
+        because of a network error or a timeout.
+        """
+        delay = 1
+        while True:
+            try:
+                with gevent.Timeout(self.healer_timeout):
+                    healer = plugin(name)
+            except HEALER_RETRY_ERRORS as e:
+                logger.error("Failed to initialize healer %s: %s, retrying in %ss" % (name, e, delay))
+                gevent.sleep(delay)
+                delay = min(delay * 2, HEALER_MAX_RETRY_DELAY)
+            except Exception as e:
+                logger.error("Failed to initialize healer %s: %s" % (name, e))
+                return
+            else:
+                break
+        self._healers_by_name[name] = healer
+        self._register_healer(healer)
+        healer.start()
+        logger.info("Connection pools: %s" % registry.stats())
+
+    def _reload(self):
+        logger.info("Reloading healers configuration")
+        for name, healer in self._healers_by_name.items():
+            if healer.config_file is None:
+                continue
+            try:
+                healer.reload_config()
+            except CommandError as e:
+                logger.error("Failed to reload %s configuration: %s" % (name, e))
 
     def _register_healer(self, healer):
-        if healer.resource not in self._healers:
-            self._healers[healer.resource] = {}
-        for oper in healer.on:
-            if oper not in self._healers[healer.resource]:
-                self._healers[healer.resource][oper] = []
-            self._healers[healer.resource][oper].append(healer)
-
-    def _start_healers(self):
-        for resource_type, opers in self._healers.items():
-            for oper, healers in opers.items():
-                for healer in healers:
-                    pool.spawn(healer.start)
+        self._dispatch.add(healer)
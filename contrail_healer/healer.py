@@ -3,7 +3,10 @@ from __future__ import unicode_literals
 
 import os
 import abc
+import math
+import time
 import logging
+from collections import deque
 from six import add_metaclass
 try:
     from ConfigParser import ConfigParser
@@ -11,21 +14,50 @@ except ImportError:
     from configparser import ConfigParser
 
 import gevent
-from gevent.queue import Queue, Empty
+from gevent.queue import Queue, Empty, Full
+from gevent.threadpool import ThreadPool
 
 from contrail_api_cli.command import Command
 from contrail_api_cli.exceptions import CommandError
 from contrail_api_cli.utils import printo
 
 from .pool import Pool
+from .registry import Registry
 
 
 logger = logging.getLogger(__name__)
 pool = Pool()
-
-
-HEALER_PARAMS = ('buffer_timeout', 'buffer_size',
-                 'check_delay', 'max_check_retries')
+registry = Registry()
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if str(value).lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(value)
+
+
+HEALER_PARAMS = {
+    'buffer_timeout': float,
+    'buffer_size': int,
+    'check_delay': float,
+    'max_check_retries': int,
+    'adaptive': to_bool,
+    'min_buffer_timeout': float,
+    'max_buffer_timeout': float,
+    'max_buffer_size': int,
+}
+"""Tunable healer parameters and their types"""
+
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
 
 
 class HealerError(gevent.GreenletExit):
@@ -45,6 +77,15 @@ class Operation:
     """delete operation"""
 
 
+class Execution:
+    """Where healer checks and fixes are run.
+    """
+    HUB = 'hub'
+    """in greenlets, checks and fixes must be gevent friendly"""
+    THREAD = 'thread'
+    """in a pool of native threads"""
+
+
 class Timer(object):
 
     def __init__(self, timeout):
@@ -59,13 +100,97 @@ class Timer(object):
     def _is_ready(self):
         self.ready = True
 
-    def reset(self):
+    def reset(self, timeout=None):
+        if timeout is not None:
+            self._timeout = timeout
         self.ready = False
         if self._g is not None:
             gevent.kill(self._g)
         self.start()
 
 
+class AdaptiveWindow(object):
+    """Compute the buffer window from the notifications arrival rate
+    and the ratio of duplicate notifications.
+
+    Both are measured over the notifications received during the last
+    `horizon` seconds, independently of the current buffer window, so
+    that duplicates are seen even when the buffer holds a single item.
+
+    When duplicates are rare buffering is useless and the window shrinks
+    toward immediate dispatch. Otherwise the window widens and the buffer
+    is sized to hold the notifications expected during the window. While
+    the arrival rate is high the window doesn't go below `min_step`.
+    """
+    dup_threshold = 0.1
+    """Duplicate ratio above which the window is widened"""
+    min_step = 0.1
+    """Smallest non-zero buffer timeout in seconds"""
+    max_arrivals = 10000
+    """Max number of notifications remembered"""
+
+    def __init__(self, horizon=5):
+        self.horizon = horizon
+        self._arrivals = deque()
+        self._counts = {}
+        self._duplicates = 0
+
+    def _expire(self, now):
+        while self._arrivals and (self._arrivals[0][0] < now - self.horizon or
+                                  len(self._arrivals) > self.max_arrivals):
+            _, key, duplicate = self._arrivals.popleft()
+            self._counts[key] -= 1
+            if self._counts[key] == 0:
+                del self._counts[key]
+            if duplicate:
+                self._duplicates -= 1
+
+    def add(self, key, now):
+        """Account for a received notification.
+
+        :param key: notification identity
+        :param now: reception time
+        """
+        self._expire(now)
+        duplicate = key in self._counts
+        self._counts[key] = self._counts.get(key, 0) + 1
+        self._arrivals.append((now, key, duplicate))
+        if duplicate:
+            self._duplicates += 1
+
+    def stats(self, now):
+        """Arrival rate in notifications per second and
+        duplicate ratio over the horizon.
+
+        :rtype: (float, float)
+        """
+        self._expire(now)
+        arrivals = len(self._arrivals)
+        if arrivals == 0:
+            return 0.0, 0.0
+        return arrivals / float(self.horizon), self._duplicates / float(arrivals)
+
+    def window(self, timeout, min_timeout, max_timeout, max_size, now):
+        """Return the new buffer size and buffer timeout.
+
+        :rtype: (int, float)
+        """
+        rate, dup_ratio = self.stats(now)
+        if dup_ratio < self.dup_threshold:
+            timeout = timeout / 2.0
+            if timeout < self.min_step:
+                timeout = 0
+        else:
+            timeout = max(timeout * 2, self.min_step)
+        if rate * self.min_step >= 1:
+            # high rate, never dispatch item by item
+            timeout = max(timeout, self.min_step)
+        timeout = min(max(timeout, min_timeout), max_timeout)
+        size = int(math.ceil(rate * timeout))
+        size = min(max(size, 1), max_size)
+        return size, timeout
+
+
 @add_metaclass(abc.ABCMeta)
 class Healer(Command):
     """Base class for Healers.
@@ -87,6 +212,26 @@ class Healer(Command):
             resource = 'virtual-ip'
             on = Operation.CREATE
 
+    *Notification filters*
+
+    A Healer can restrict the notifications it receives with predicates
+    on the notification fields in a `where` attribute. Fields are dotted
+    paths in the notification. A predicate is either a value the field
+    must be equal to or a callable that gets the field value (`None` if the
+    field is missing) and returns `True` if the notification is accepted::
+
+        class MyHealer(Healer):
+            resource = 'virtual-machine-interface'
+            on = Operation.UPDATE
+            where = {
+                'obj_dict.virtual_machine_interface_device_owner': 'network:router_interface',
+                'obj_dict.fq_name': lambda fq_name: fq_name and fq_name[1] == 'admin',
+            }
+
+    Value predicates are indexed so notifications not accepted by a healer
+    never reach it. `resource` can be `'*'` to get notifications on all
+    resource types.
+
     *Healer queue and buffer*
 
     Each Healer has a public input queue and an internal buffer queue.
@@ -129,6 +274,60 @@ class Healer(Command):
 
     Each retry will be delayed by 1s on each iteration.
 
+    The checks of notifications taken from the buffer at the same time
+    are run concurrently and their fixes are given to
+    :func:`Healer.fix_many` so that they can be applied in batches.
+    Failed fixes are retried like checks.
+
+    *Runtime tuning*
+
+    `buffer_timeout`, `buffer_size`, `check_delay` and `max_check_retries`
+    can be changed on a running healer with :func:`Healer.set_param` or
+    by reloading the configuration with :func:`Healer.reload_config`.
+    Resizing the buffer doesn't lose any notification.
+
+    A healer can be paused with :func:`Healer.pause`: notifications are
+    still received but no check is made until :func:`Healer.resume` is
+    called. :func:`Healer.drain` checks all pending notifications right
+    away.
+
+    *Adaptive buffer*
+
+    When `adaptive` is `True` the buffer size and timeout are tuned after
+    each flush from the arrival rate and duplicate ratio of the
+    notifications received during the last `max_buffer_timeout` seconds
+    (see :class:`AdaptiveWindow`). The buffer timeout stays
+    between `min_buffer_timeout` and `max_buffer_timeout` and the buffer
+    size is at most `max_buffer_size`::
+
+        class MyHealer(Healer):
+            adaptive = True
+            max_buffer_timeout = 2
+
+    The current window is available in :attr:`Healer.window`.
+
+    *Execution mode*
+
+    By default checks and fixes run in greenlets and must not block the
+    gevent hub. Healers using blocking libraries or doing heavy
+    computations can run their checks and fixes in a bounded pool of
+    native threads while buffering and retries stay on the hub::
+
+        from contrail_healer.healer import Healer, Execution
+
+        class MyHealer(Healer):
+            execution = Execution.THREAD
+            thread_pool_size = 4
+
+    Pool usage and queue times are available in :attr:`Healer.executor`.
+
+    *In-flight checks*
+
+    At most one check runs at a time for a given resource. If notifications
+    on a resource arrive while a check on that resource is in progress they
+    are folded into a single follow-up notification that is queued again
+    once the current check is finished.
+
     *Healer configuration*
 
     Each Healer can use a configuration file for its own usage. The
@@ -139,6 +338,21 @@ class Healer(Command):
     configuration is available in `self.config` which is a
     :class:`ConfigParser` object.
 
+    *Healer source*
+
+    When notifications are consumed from several RabbitMQ sources a
+    healer without source gets the notifications of all the sources. A
+    healer can be bound to a source with its `source` attribute or the
+    `source` option of the `default` section of its configuration file,
+    it then only gets the notifications of this source::
+
+        [default]
+        source = dc1
+
+    Healers working on the resources of a single cluster must refuse to
+    start without source when several sources are used, the sources
+    names are available in :attr:`contrail_healer.registry.Registry.sources`.
+
     """
     buffer_timeout = 5
     """Internal buffer lifetime in seconds"""
@@ -150,27 +364,210 @@ class Healer(Command):
     """Check delay in seconds"""
     max_check_retries = 3
     """Max retries for failed checks"""
+    where = None
+    """Predicates on notification fields"""
+    adaptive = False
+    """Tune the buffer size and timeout to the notifications rate"""
+    min_buffer_timeout = 0
+    """Min buffer timeout in seconds in adaptive mode"""
+    max_buffer_timeout = 5
+    """Max buffer timeout in seconds in adaptive mode"""
+    max_buffer_size = 100
+    """Max buffer size in adaptive mode"""
+    execution = Execution.HUB
+    """Where checks and fixes are run"""
+    thread_pool_size = 4
+    """Number of threads when running in a thread pool"""
+    source = None
+    """Name of the source notifications are accepted from, all sources if `None`"""
 
     def __init__(self, *args):
         super(Healer, self).__init__(*args)
         self.queue = Queue()
         self.started = False
+        self.paused = False
+        self._buffer = None
         if self.config_file is not None:
-            self.config = ConfigParser()
-            reads = self.config.read(['/etc/contrail-healer/%s' % self.config_file,
-                                      os.path.expanduser('~/.config/contrail-healer/%s' % self.config_file)])
-            if len(reads) == 0:
-                raise CommandError('Failed to read configuration')
-
-            for (config_key, config_value) in self.config.items('default'):
-                if config_key in HEALER_PARAMS:
-                    self.log_debug("Setting %s = %s" % (config_key, config_value))
-                    setattr(self, config_key, config_value)
+            self.reload_config()
+            if self.config.has_option('default', 'source'):
+                self.source = self.config.get('default', 'source')
+        if self.source is not None and registry.sources and \
+                self.source not in registry.sources:
+            raise CommandError('Unknown source %s' % self.source)
         else:
             self.config = None
 
         self._buffer = Queue(maxsize=self.buffer_size)
         self._retries = {}
+        self._inflight = set()
+        self._pending = {}
+        self._adaptive_window = AdaptiveWindow(max(self.max_buffer_timeout, 1))
+        self._threadpool = None
+        if self.execution == Execution.THREAD:
+            self._threadpool = ThreadPool(self.thread_pool_size)
+        self._executor_stats = {
+            'tasks': 0,
+            'queue_time': 0.0,
+            'max_queue_time': 0.0,
+            'run_time': 0.0,
+        }
+
+    def reload_config(self):
+        """(Re)load the healer configuration file and apply
+        healer parameters found in the `default` section.
+        """
+        config = ConfigParser()
+        reads = config.read(['/etc/contrail-healer/%s' % self.config_file,
+                             os.path.expanduser('~/.config/contrail-healer/%s' % self.config_file)])
+        if len(reads) == 0:
+            raise CommandError('Failed to read configuration')
+
+        # validate all the parameters before applying any of them
+        params = {}
+        for (config_key, config_value) in config.items('default'):
+            if config_key in HEALER_PARAMS:
+                try:
+                    params[config_key] = self._convert_param(config_key, config_value)
+                except ValueError as e:
+                    raise CommandError(str(e))
+        for name, value in params.items():
+            self.set_param(name, value)
+        self.config = config
+
+    @property
+    def params(self):
+        """Current healer parameters.
+
+        :rtype: dict
+        """
+        return dict((name, getattr(self, name)) for name in HEALER_PARAMS)
+
+    def set_param(self, name, value):
+        """Set a healer parameter.
+
+        :param name: one of :data:`HEALER_PARAMS`
+        :type name: str
+        :param value: new value, converted to the parameter type
+        :raises ValueError: unknown parameter or invalid value
+        """
+        value = self._convert_param(name, value)
+        self.log_debug("Setting %s = %s", name, value)
+        setattr(self, name, value)
+        if name == 'buffer_size' and self._buffer is not None:
+            self._resize_buffer(value)
+
+    def _convert_param(self, name, value):
+        if name not in HEALER_PARAMS:
+            raise ValueError("Unknown parameter %s" % name)
+        try:
+            value = HEALER_PARAMS[name](value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid value %s for %s" % (value, name))
+        if value < 0 or (name == 'buffer_size' and value < 1):
+            raise ValueError("Invalid value %s for %s" % (value, name))
+        return value
+
+    def _resize_buffer(self, size):
+        old_buffer = self._buffer
+        self._buffer = Queue(maxsize=size)
+        self._move_buffer(old_buffer)
+
+    def _move_buffer(self, old_buffer):
+        overflow = []
+        while True:
+            try:
+                work = old_buffer.get_nowait()
+            except Empty:
+                break
+            if not self._buffer.full():
+                self._buffer.put_nowait(work)
+            elif work not in overflow:
+                overflow.append(work)
+        # notifications that don't fit in the new buffer are queued
+        # again, checks must not start while the healer is paused
+        for work in overflow:
+            self.queue.put_nowait(work)
+
+    @property
+    def window(self):
+        """Current buffer window and the statistics used
+        in adaptive mode.
+
+        :rtype: dict
+        """
+        rate, dup_ratio = self._adaptive_window.stats(time.time())
+        return {
+            'buffer_size': self.buffer_size,
+            'buffer_timeout': self.buffer_timeout,
+            'rate': rate,
+            'dup_ratio': dup_ratio,
+        }
+
+    @property
+    def executor(self):
+        """Execution mode and usage of the thread pool.
+
+        Times are totals in seconds since the healer creation.
+
+        :rtype: dict
+        """
+        stats = dict(self._executor_stats, execution=self.execution)
+        if self._threadpool is not None:
+            stats['pool_size'] = self._threadpool.maxsize
+            stats['threads'] = self._threadpool.size
+            stats['queued'] = self._threadpool.task_queue.qsize()
+        return stats
+
+    def _execute(self, func, *args):
+        """Run `func` according to the healer execution mode.
+        """
+        if self._threadpool is None:
+            return func(*args)
+        submitted = time.time()
+
+        def run():
+            started = time.time()
+            try:
+                return func(*args)
+            finally:
+                stats = self._executor_stats
+                queue_time = started - submitted
+                stats['tasks'] += 1
+                stats['queue_time'] += queue_time
+                stats['max_queue_time'] = max(stats['max_queue_time'], queue_time)
+                stats['run_time'] += time.time() - started
+        return self._threadpool.apply(run)
+
+    def _adapt(self):
+        if not self.adaptive:
+            return
+        self._adaptive_window.horizon = max(self.max_buffer_timeout, 1)
+        size, timeout = self._adaptive_window.window(self.buffer_timeout,
+                                                     self.min_buffer_timeout,
+                                                     self.max_buffer_timeout,
+                                                     self.max_buffer_size,
+                                                     time.time())
+        if timeout != self.buffer_timeout:
+            self.set_param('buffer_timeout', timeout)
+        if size != self.buffer_size:
+            self.set_param('buffer_size', size)
+
+    def pause(self):
+        """Stop checking notifications until :func:`Healer.resume`
+        is called.
+        """
+        self.paused = True
+        self.log("paused")
+
+    def resume(self):
+        self.paused = False
+        self.log("resumed")
+
+    def drain(self):
+        """Check all buffered and queued notifications now.
+        """
+        self.log("draining")
+        self._process_buffer(include_queue=True)
 
     def start(self):
         if self.started is False:
@@ -182,43 +579,97 @@ class Healer(Command):
     def _receive(self):
         while True:
             work = self.queue.get()
-            self.log_debug("got %s on %s" % (work[0], work[1]))
-            # put work to do in a buffer to avoid duplicate notifications
-            self._buffer.put(work)
+            self.log_debug("got %s on %s", work[0], work[1],
+                           oper=work[0], resource=work[1])
+            if self.adaptive:
+                self._adaptive_window.add((work[0], self._inflight_key(work[1])),
+                                          time.time())
+            # put work to do in a buffer to avoid duplicate notifications,
+            # the buffer can be replaced when resized
+            while True:
+                buffer = self._buffer
+                try:
+                    buffer.put(work, timeout=1)
+                except Full:
+                    continue
+                if buffer is not self._buffer:
+                    self._move_buffer(buffer)
+                break
 
     def _work(self):
         timer = Timer(self.buffer_timeout)
         while True:
-            if self._buffer.empty():
-                self.log_debug("buffer is empty")
-                timer.reset()
+            if self.paused:
                 gevent.sleep(0.1)
                 continue
+            elif self._buffer.empty():
+                self.log_debug("buffer is empty")
+                timer.reset(self.buffer_timeout)
+                # wake up as soon as something is buffered
+                try:
+                    self._buffer.peek(timeout=0.1)
+                except Empty:
+                    pass
+                continue
             elif not self._buffer.full() and timer.ready is False:
                 self.log_debug("buffer is not full and timer is not ready")
-                gevent.sleep(0.1)
+                gevent.sleep(min(0.1, self.buffer_timeout))
                 continue
             else:
                 if timer.ready:
                     self.log_debug("timer ready process buffer")
                 else:
                     self.log_debug("buffer full process buffer")
-                timer.reset()
+                timer.reset(self.buffer_timeout)
                 self._process_buffer()
 
-    def _process_buffer(self):
+    def _process_buffer(self, include_queue=False):
         to_process = []
-        while True:
-            try:
-                work = self._buffer.get_nowait()
-                if work not in to_process:
-                    to_process.append(work)
-            except Empty:
-                break
-
-        for (oper, r) in to_process:
-            self.log_debug("processing %s on %s" % (oper, r))
-            pool.spawn_later(self.check_delay, self._heal, oper, r)
+        queues = [self._buffer]
+        if include_queue:
+            queues.append(self.queue)
+        for queue in queues:
+            while True:
+                try:
+                    work = queue.get_nowait()
+                    if work not in to_process:
+                        to_process.append(work)
+                except Empty:
+                    break
+
+        self._adapt()
+        self._schedule(to_process)
+
+    def _inflight_key(self, r):
+        return getattr(r, 'uuid', None) or r
+
+    def _schedule(self, works):
+        batch = []
+        for (oper, r) in works:
+            key = self._inflight_key(r)
+            if key in self._inflight:
+                # a check is already running on this resource, keep only
+                # the last notification for a follow-up check
+                self.log_debug("check in progress on %s, deferring %s", r, oper,
+                               oper=oper, resource=r)
+                self._pending[key] = (oper, r)
+                continue
+            self._inflight.add(key)
+            self.log_debug("processing %s on %s", oper, r,
+                           oper=oper, resource=r)
+            batch.append((key, oper, r))
+        if batch:
+            pool.spawn_later(self.check_delay, self._run, batch)
+
+    def _run(self, batch):
+        try:
+            self._heal(batch)
+        finally:
+            for (key, oper, r) in batch:
+                self._inflight.discard(key)
+                if key in self._pending:
+                    # buffered again so that pause is honored
+                    self.queue.put(self._pending.pop(key))
 
     def _retry(self, oper, r):
         if (oper, r) not in self._retries:
@@ -228,21 +679,41 @@ class Healer(Command):
 
         nb_retries = self._retries[(oper, r)]
         if nb_retries <= self.max_check_retries:
-            self.log("retrying check on %s in %ss" % (r, nb_retries))
-            pool.spawn_later(nb_retries, self._buffer.put, (oper, r))
+            self.log("retrying check on %s in %ss", r, nb_retries,
+                     oper=oper, resource=r)
+            pool.spawn_later(nb_retries, self.queue.put, (oper, r))
         else:
-            self.log("reach max_check_retries on %s" % r)
+            self.log("reach max_check_retries on %s", r,
+                     oper=oper, resource=r)
             del self._retries[(oper, r)]
 
-    def _heal(self, oper, r):
-        result = self.check(oper, r)
-        if result[0] is False:
-            self.log("%s NOT OK. FIXING!" % r)
-            self.fix(*result[1:])
-        elif result[0] is None:
-            self._retry(oper, r)
-        else:
-            self.log("%s is OK" % r)
+    def _heal(self, batch):
+        checks = [pool.spawn(self._execute, self.check, oper, r)
+                  for (key, oper, r) in batch]
+        gevent.joinall(checks)
+        to_fix = []
+        fixes = []
+        for (key, oper, r), check in zip(batch, checks):
+            if not check.successful():
+                self.log_error("check failed on %s: %s", r, check.exception,
+                               oper=oper, resource=r)
+                continue
+            result = check.value
+            if result[0] is False:
+                self.log("%s NOT OK. FIXING!", r, oper=oper, resource=r)
+                to_fix.append((oper, r))
+                fixes.append(result[1:])
+            elif result[0] is None:
+                self._retry(oper, r)
+            else:
+                self.log("%s is OK", r, oper=oper, resource=r)
+        if not fixes:
+            return
+        for (oper, r), result in zip(to_fix, self._execute(self.fix_many, fixes)):
+            if isinstance(result, Exception):
+                self.log_error("fix failed on %s: %s", r, result,
+                               oper=oper, resource=r)
+                self._retry(oper, r)
 
     @property
     def has_json_formatter(self):
@@ -275,21 +746,42 @@ class Healer(Command):
             self._log_methods['info'] = printo
         return self._log_methods
 
-    def log(self, message, msg_type='info'):
+    def log(self, message, *args, **kwargs):
+        """Log a message.
+
+        `args` are interpolated in the message only if the message
+        is emitted. The `oper` and `resource` keyword arguments are
+        added to the log record as `oper` and `uuid` extra fields.
+
+        :param msg_type: debug, info, warning or error (default: info)
+        :type msg_type: str
+        """
+        msg_type = kwargs.pop('msg_type', 'info')
         if self.has_json_formatter:
-            self.log_methods[msg_type](message, extra={'healer': self.__class__.__name__})
+            if not logger.isEnabledFor(LOG_LEVELS[msg_type]):
+                return
+            extra = {'healer': self.__class__.__name__}
+            if 'oper' in kwargs:
+                extra['oper'] = kwargs['oper']
+            if 'resource' in kwargs:
+                extra['uuid'] = self._inflight_key(kwargs['resource'])
+            self.log_methods[msg_type](message, *args, extra=extra)
         else:
+            if msg_type != 'info' and not logger.isEnabledFor(LOG_LEVELS[msg_type]):
+                return
+            if args:
+                message = message % args
             message = '[%s] %s' % (self.__class__.__name__, message)
             self.log_methods[msg_type](message)
 
-    def log_debug(self, message):
-        self.log(message, msg_type='debug')
+    def log_debug(self, message, *args, **kwargs):
+        self.log(message, *args, msg_type='debug', **kwargs)
 
-    def log_warning(self, message):
-        self.log(message, msg_type='warning')
+    def log_warning(self, message, *args, **kwargs):
+        self.log(message, *args, msg_type='warning', **kwargs)
 
-    def log_error(self, message):
-        self.log(message, msg_type='error')
+    def log_error(self, message, *args, **kwargs):
+        self.log(message, *args, msg_type='error', **kwargs)
 
     def __call__(self):
         # a Healer cannot be called alone for now.
@@ -329,3 +821,23 @@ class Healer(Command):
         \*args are provided in the return of the check method.
         """
         pass
+
+    def fix_many(self, fixes):
+        """Run the fixes of the checks made in the same buffer flush.
+
+        By default :func:`Healer.fix` is called for each fix. Healers
+        can override this method to apply fixes in batches.
+
+        :param fixes: list of arguments for :func:`Healer.fix`
+        :type fixes: [tuple]
+        :returns: the result of each fix, an exception instance if
+                  the fix failed and must be retried
+        :rtype: list
+        """
+        results = []
+        for args in fixes:
+            try:
+                results.append(self.fix(*args))
+            except Exception as e:
+                results.append(e)
+        return results
@@ -1,15 +1,54 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from array import array
+from itertools import chain
+from bisect import bisect_left, bisect_right
+
+import gevent
 from netaddr import IPAddress, IPNetwork
 
-from kazoo.client import KazooClient
-from kazoo.handlers.gevent import SequentialGeventHandler
+from kazoo.exceptions import NoNodeError, NodeExistsError, RolledBackError, RuntimeInconsistency
 
 from contrail_api_cli.exceptions import CommandError, ResourceNotFound
 from contrail_api_cli.resource import Resource
 
-from ..healer import Healer, Operation
+from ..healer import Healer, Operation, pool
+from ..registry import Registry
+
+
+registry = Registry()
+
+
+MAX_IPV4 = 2 ** 32 - 1
+
+
+def sorted_addresses(addresses):
+    """Build a compact sorted array of IPv4 addresses.
+
+    IPv6 addresses are skipped.
+
+    :param addresses: IP addresses as strings or integers
+    :rtype: array
+    """
+    ips = (IPAddress(a) for a in addresses)
+    return array(str('I'), sorted(int(ip) for ip in ips if ip.version == 4))
+
+
+def difference(a, b):
+    """Elements of the sorted sequence `a` not in the sorted sequence `b`.
+    """
+    j = 0
+    for x in a:
+        while j < len(b) and b[j] < x:
+            j += 1
+        if j == len(b) or b[j] != x:
+            yield x
+
+
+def contains(a, x):
+    i = bisect_left(a, x)
+    return i < len(a) and a[i] == x
 
 
 class FIPHealer(Healer):
@@ -17,37 +56,174 @@ class FIPHealer(Healer):
 
     This healer makes sure a znode has been correclty created after a
     FIP creation.
+
+    Missing znodes are created in ZooKeeper transactions of at most
+    `zk_batch_size` operations.
+
+    :func:`FIPHealer.audit` compares all the allocations of the public VN
+    IPv4 subnets in ZooKeeper with the floating-ips of the VN in
+    contrail-api. Missing znodes are fixed through the healer queue,
+    orphaned znodes are only reported. The audit runs every `audit_interval` seconds if
+    set in the configuration file and can be triggered through the
+    control socket.
+
+    A FIPHealer works on a single cluster. When notifications are consumed
+    from several RabbitMQ sources the `source` of the cluster `zk_server`
+    belongs to must be set in the configuration file, otherwise the healer
+    doesn't start.
     """
     on = Operation.CREATE
     resource = 'floating-ip'
     config_file = 'fip-healer.conf'
     check_delay = 2
+    zk_batch_size = 100
+    """Max number of znodes created in a single transaction"""
 
     def __init__(self, *args):
         super(FIPHealer, self).__init__(*args)
-        zk_server = self.config.get('default', 'zk_server')
-        handler = SequentialGeventHandler()
-        self.zk_client = KazooClient(hosts=zk_server, timeout=1.0,
-                                     handler=handler)
+        if self.source is None and len(registry.sources) > 1:
+            raise CommandError('A source must be set, several sources are used')
+        self.zk_server = self.config.get('default', 'zk_server')
+        self.zk_client = registry.zk_client(self.zk_server)
+        self._zk_parents = set()
+
         try:
-            self.zk_client.start()
-        except handler.timeout_exception:
-            raise CommandError("Can't connect to Zookeeper at %s" % zk_server)
-
-        self.vn = Resource('virtual-network',
-                           fq_name=self.config.get('default', 'public_vn_fqname'),
-                           fetch=True)
-        self.subnets = []
-        for s in self.vn['network_ipam_refs'][0]['attr']['ipam_subnets']:
-            self.subnets.append(IPNetwork('%s/%s' % (s['subnet']['ip_prefix'], s['subnet']['ip_prefix_len'])))
+            self._fetch_vn()
+        except BaseException:
+            # initialization is retried, don't keep a reference on the client
+            registry.release_zk_client(self.zk_server)
+            raise
+        self.where = {
+            'obj_dict.fq_name': self._in_public_vn,
+        }
+        self.audit_interval = 0
+        if self.config.has_option('default', 'audit_interval'):
+            self.audit_interval = self.config.getint('default', 'audit_interval')
+
+    def _fetch_vn(self):
+        vn = Resource('virtual-network',
+                      fq_name=self.config.get('default', 'public_vn_fqname'),
+                      fetch=True)
+        subnets = []
+        for s in vn['network_ipam_refs'][0]['attr']['ipam_subnets']:
+            subnets.append(IPNetwork('%s/%s' % (s['subnet']['ip_prefix'], s['subnet']['ip_prefix_len'])))
+        self.vn = vn
+        self.subnets = subnets
+
+    def start(self):
+        if self.started is False and self.audit_interval > 0:
+            pool.spawn(self._audit_loop)
+        super(FIPHealer, self).start()
+
+    def _audit_loop(self):
+        while True:
+            gevent.sleep(self.audit_interval)
+            try:
+                self.audit()
+            except Exception as e:
+                self.log_error("audit failed: %s", e)
+
+    def _in_public_vn(self, fq_name):
+        # FIP fq_name is <vn fq_name>:<pool>:<fip>
+        if fq_name is None:
+            return True
+        return list(fq_name[:-2]) == list(self.vn.fq_name)
 
     def _get_subnet_for_ip(self, ip, subnets):
         for subnet in subnets:
             if ip in subnet:
                 return subnet
 
+    def _zk_path_for_subnet(self, subnet):
+        return '/api-server/subnets/%s:%s' % (self.vn.fq_name, subnet)
+
     def _zk_node_for_ip(self, ip, subnet):
-        return '/api-server/subnets/%s:%s/%i' % (self.vn.fq_name, subnet, ip)
+        return '%s/%i' % (self._zk_path_for_subnet(subnet), ip)
+
+    def _api_items(self, resource_type, field, **params):
+        session = self.vn.session
+        collection = '%ss' % resource_type
+        data = session.get_json('%s/%s' % (session.base_url, collection),
+                                fields=field, **params)
+        for item in data.get(collection, []):
+            if item.get(field):
+                yield item
+
+    def _api_addresses(self, resource_type, field, **params):
+        for item in self._api_items(resource_type, field, **params):
+            yield item[field]
+
+    def _zk_addresses(self, subnet):
+        try:
+            children = self.zk_client.get_children(self._zk_path_for_subnet(subnet))
+        except NoNodeError:
+            children = []
+        addresses = (int(c) for c in children if c.isdigit())
+        return array(str('I'), sorted(a for a in addresses if a <= MAX_IPV4))
+
+    def audit(self):
+        """Compare IP allocations in ZooKeeper with floating-ips addresses
+        of the public VN.
+
+        FIPs with a missing znode are put in the healer queue to be
+        checked and fixed like notified FIPs.
+
+        Allocations of instance-ips and subnets gateway and service
+        addresses are not reported as orphaned. IPv6 subnets are not
+        audited.
+
+        contrail-api returns each listing in a single response, only the
+        addresses are kept from it in compact arrays, along with the
+        uuid of FIPs with a missing znode.
+
+        :returns: number of missing and orphaned znodes
+        :rtype: dict
+        """
+        # get pools and subnets added since the last audit
+        self._fetch_vn()
+        subnets = [s for s in self.subnets if s.version == 4]
+        # read ZooKeeper first, FIPs created meanwhile are only
+        # reported as missing and checked
+        allocations = [(subnet, self._zk_addresses(subnet)) for subnet in subnets]
+
+        pools = [p['uuid'] for p in self.vn.get('floating_ip_pools', [])]
+        fips = array(str('I'))
+        missing = {}
+        if pools:
+            for item in self._api_items('floating-ip', 'floating_ip_address',
+                                        parent_id=','.join(pools)):
+                ip = IPAddress(item['floating_ip_address'])
+                if ip.version != 4:
+                    continue
+                fips.append(int(ip))
+                for subnet, allocated in allocations:
+                    if subnet.first <= ip.value <= subnet.last:
+                        if not contains(allocated, ip.value):
+                            missing[ip.value] = item
+                        break
+        fips = array(str('I'), sorted(fips))
+
+        reserved = []
+        for s in self.vn['network_ipam_refs'][0]['attr']['ipam_subnets']:
+            reserved.extend(s[k] for k in ('default_gateway', 'dns_server_address') if s.get(k))
+        known = sorted_addresses(chain(self._api_addresses('instance-ip', 'instance_ip_address',
+                                                           back_ref_id=self.vn.uuid), reserved))
+
+        orphaned = 0
+        for subnet, allocated in allocations:
+            subnet_fips = fips[bisect_left(fips, subnet.first):bisect_right(fips, subnet.last)]
+            for ip in difference(allocated, subnet_fips):
+                if not contains(known, ip):
+                    orphaned += 1
+                    self.log_warning("orphaned znode %s", self._zk_node_for_ip(ip, subnet))
+
+        self.log("audit: %s missing, %s orphaned znodes", len(missing), orphaned)
+        for item in missing.values():
+            fip = Resource('floating-ip', uuid=item['uuid'],
+                           fq_name=item['fq_name'],
+                           floating_ip_address=item['floating_ip_address'])
+            self.queue.put(('CREATE', fip))
+        return {'missing': len(missing), 'orphaned': orphaned}
 
     def check(self, oper, fip):
         try:
@@ -57,12 +233,71 @@ class FIPHealer(Healer):
         ip = IPAddress(fip.get('floating_ip_address'))
         subnet = self._get_subnet_for_ip(ip, self.subnets)
         if subnet is None:
-            self.log_error('No subnet found for FIP %s' % fip)
+            self.log_error('No subnet found for FIP %s', fip,
+                           oper=oper, resource=fip)
             return (None,)
         zk_node = self._zk_node_for_ip(ip, subnet)
         return (self.zk_client.exists(zk_node), zk_node, self.vn.uuid)
 
     def fix(self, zk_node, data):
-        return self.zk_client.create(zk_node,
-                                     value=str(data),
-                                     makepath=True)
+        result = self.fix_many([(zk_node, data)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _ensure_parent(self, zk_node):
+        parent = zk_node.rsplit('/', 1)[0]
+        if parent not in self._zk_parents:
+            self.zk_client.ensure_path(parent)
+            self._zk_parents.add(parent)
+
+    def fix_many(self, fixes):
+        results = [None] * len(fixes)
+        for start in range(0, len(fixes), self.zk_batch_size):
+            todo = list(range(start, min(start + self.zk_batch_size, len(fixes))))
+            for i in todo:
+                try:
+                    self._ensure_parent(fixes[i][0])
+                except Exception as e:
+                    results[i] = e
+            todo = [i for i in todo if results[i] is None]
+            while todo:
+                todo = self._commit(fixes, todo, results)
+        return results
+
+    def _commit(self, fixes, todo, results):
+        """Create znodes in a transaction.
+
+        When the transaction fails the operations rolled back
+        because of another failing operation are returned to be
+        committed again.
+        """
+        transaction = self.zk_client.transaction()
+        for i in todo:
+            zk_node, data = fixes[i]
+            transaction.create(zk_node, value=str(data))
+        try:
+            commit = transaction.commit()
+        except Exception as e:
+            for i in todo:
+                results[i] = e
+            return []
+        retry = []
+        for i, result in zip(todo, commit):
+            if isinstance(result, (RolledBackError, RuntimeInconsistency)):
+                retry.append(i)
+            elif isinstance(result, NodeExistsError):
+                # created in the meantime
+                results[i] = fixes[i][0]
+            elif isinstance(result, NoNodeError):
+                # the parent was removed, create it again on retry
+                self._zk_parents.discard(fixes[i][0].rsplit('/', 1)[0])
+                results[i] = result
+            else:
+                results[i] = result
+        # nothing failed but the transaction was rolled back
+        if len(retry) == len(todo):
+            for i in retry:
+                results[i] = RolledBackError()
+            return []
+        return retry
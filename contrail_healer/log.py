@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Non-blocking logging handler.
+
+:class:`AsyncStreamHandler` can replace `logging.StreamHandler` in the
+logging configuration so that records are written from a background
+thread instead of the gevent hub::
+
+    [handler_consoleHandler]
+    class=contrail_healer.log.AsyncStreamHandler
+    formatter=jsonFormatter
+    args=(sys.stdout,)
+
+Records are formatted when they are emitted, like
+`logging.handlers.QueueHandler` does, so that the arguments are not
+read later from another thread.
+"""
+from __future__ import unicode_literals
+
+import copy
+import logging
+import threading
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+
+class AsyncStreamHandler(logging.StreamHandler):
+
+    def __init__(self, stream=None, maxsize=10000):
+        """
+        :param stream: stream to write to (default: sys.stderr)
+        :param maxsize: max number of pending records, records
+                        are dropped when the queue is full
+        :type maxsize: int
+        """
+        super(AsyncStreamHandler, self).__init__(stream)
+        self._queue = Queue(maxsize=maxsize)
+        self._thread = None
+        self.dropped = 0
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._write)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            try:
+                self.stream.write(record.msg + '\n')
+                self.flush()
+            except Exception:
+                self.handleError(record)
+
+    def prepare(self, record):
+        """Format the record and drop its arguments.
+        """
+        msg = self.format(record)
+        record = copy.copy(record)
+        record.message = msg
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        if self._thread is None:
+            self._start()
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            if self.dropped:
+                self.stream.write("%s log records dropped\n" % self.dropped)
+                self.flush()
+        super(AsyncStreamHandler, self).close()
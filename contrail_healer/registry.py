@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Process-wide registry of connections shared by healers.
+
+ZooKeeper clients are pooled by ensemble hosts and reference counted so
+that healers using the same ensemble share a single session. HTTP
+connections to contrail-api are kept alive in a connection pool mounted
+by the contrail-api-cli session, which can be enlarged per endpoint.
+"""
+from __future__ import unicode_literals
+from six import add_metaclass
+
+from gevent.lock import RLock
+
+from requests.adapters import HTTPAdapter
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import KazooException
+from kazoo.handlers.gevent import SequentialGeventHandler
+
+from contrail_api_cli.context import Context
+from contrail_api_cli.exceptions import CommandError
+from contrail_api_cli.utils import Singleton
+
+
+class ZkConnectionError(CommandError):
+    pass
+
+
+@add_metaclass(Singleton)
+class Registry(object):
+
+    zk_timeout = 1.0
+    """ZooKeeper session timeout in seconds"""
+    api_pool_size = None
+    """Min number of keep-alive connections per contrail-api endpoint,
+    the pool of the contrail-api-cli session is used as is if `None`"""
+    sources = []
+    """Names of the notifications sources"""
+
+    def __init__(self):
+        self._lock = RLock()
+        self._zk_clients = {}
+        self._zk_refs = {}
+        # hosts -> lock held while connecting to the ensemble
+        self._zk_locks = {}
+        self._api_adapters = {}
+
+    def _make_zk_client(self, hosts):
+        handler = SequentialGeventHandler()
+        client = KazooClient(hosts=hosts, timeout=self.zk_timeout,
+                             handler=handler)
+        try:
+            client.start()
+        except BaseException as e:
+            # the start can also be interrupted by a caller timeout,
+            # don't leave the client reconnecting in the background
+            client.stop()
+            client.close()
+            if isinstance(e, (handler.timeout_exception, KazooException)):
+                raise ZkConnectionError("Can't connect to Zookeeper at %s" % hosts)
+            raise
+        return client
+
+    def zk_client(self, hosts):
+        """Return a started ZooKeeper client for `hosts`.
+
+        Clients are shared between all callers asking for the same hosts.
+        Each call must be matched by a call to :func:`release_zk_client`.
+        Clients for different hosts are started concurrently.
+
+        :param hosts: ZooKeeper connection string
+        :type hosts: str
+        :rtype: KazooClient
+        """
+        with self._lock:
+            lock = self._zk_locks.setdefault(hosts, RLock())
+        with lock:
+            with self._lock:
+                if hosts in self._zk_clients:
+                    self._zk_refs[hosts] += 1
+                    return self._zk_clients[hosts]
+            client = self._make_zk_client(hosts)
+            with self._lock:
+                self._zk_clients[hosts] = client
+                self._zk_refs[hosts] = 1
+            return client
+
+    def release_zk_client(self, hosts):
+        """Release a client obtained with :func:`zk_client`.
+
+        The ZooKeeper session is closed when no one uses it anymore.
+        """
+        with self._lock:
+            if hosts not in self._zk_refs:
+                return
+            self._zk_refs[hosts] -= 1
+            if self._zk_refs[hosts] > 0:
+                return
+            del self._zk_refs[hosts]
+            client = self._zk_clients.pop(hosts)
+        self._close_zk_client(client)
+
+    def _close_zk_client(self, client):
+        client.stop()
+        client.close()
+
+    def api_session(self, session=None):
+        """Return the contrail-api session and track the keep-alive
+        connection pool used for its endpoint.
+
+        A larger pool is mounted for the endpoint only if the session
+        pool is smaller than `api_pool_size`.
+
+        :param session: session to use, defaults to the contrail-api-cli
+                        context session
+        :rtype: ContrailAPISession
+        """
+        if session is None:
+            session = Context().session
+        endpoint = session.base_url
+        with self._lock:
+            if endpoint not in self._api_adapters:
+                adapter = session.session.get_adapter(endpoint)
+                pool_maxsize = getattr(adapter, '_pool_maxsize', 0)
+                if self.api_pool_size is not None and pool_maxsize < self.api_pool_size:
+                    adapter = HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=self.api_pool_size)
+                    session.session.mount(endpoint, adapter)
+                self._api_adapters[endpoint] = adapter
+        return session
+
+    def stats(self):
+        """Usage of the pooled connections.
+
+        :rtype: dict
+        """
+        with self._lock:
+            api = {}
+            for endpoint, adapter in self._api_adapters.items():
+                container = adapter.poolmanager.pools
+                pools = [container[k] for k in container.keys()]
+                api[endpoint] = {
+                    'pools': len(pools),
+                    'connections': sum(p.num_connections for p in pools),
+                    'requests': sum(p.num_requests for p in pools),
+                }
+            return {
+                'zk': dict(self._zk_refs),
+                'api': api,
+            }
+
+    def close(self):
+        """Close all pooled connections.
+        """
+        with self._lock:
+            clients = list(self._zk_clients.values())
+            self._zk_clients = {}
+            self._zk_refs = {}
+            for adapter in self._api_adapters.values():
+                adapter.close()
+            self._api_adapters = {}
+        for client in clients:
+            self._close_zk_client(client)
@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+import time
+import unittest
+
+from .test_buffer import TestHealer
+from ..healer import AdaptiveWindow
+
+
+class TestAdaptiveWindow(unittest.TestCase):
+
+    def test_shrink_without_duplicates(self):
+        w = AdaptiveWindow(horizon=5)
+        for i in range(10):
+            w.add(i, 1)
+        timeout = 5
+        for _ in range(10):
+            size, timeout = w.window(timeout, 0, 5, 100, 1)
+        self.assertEqual(timeout, 0)
+        self.assertEqual(size, 1)
+
+    def test_widen_from_zero(self):
+        # duplicates are seen even when the buffer holds a single item
+        w = AdaptiveWindow(horizon=1)
+        for i in range(100):
+            w.add(i % 20, 0.5)
+        timeout = 0
+        for _ in range(10):
+            size, timeout = w.window(timeout, 0, 2, 50, 0.5)
+        self.assertEqual(timeout, 2)
+        self.assertEqual(size, 50)
+
+    def test_floor_on_high_rate(self):
+        w = AdaptiveWindow(horizon=1)
+        for i in range(100):
+            w.add(i, 0.5)
+        size, timeout = w.window(0, 0, 5, 100, 0.5)
+        self.assertEqual(timeout, w.min_step)
+        self.assertEqual(size, 10)
+
+    def test_expire(self):
+        w = AdaptiveWindow(horizon=1)
+        w.add('a', 0)
+        w.add('a', 0)
+        self.assertEqual(w.stats(0), (2.0, 0.5))
+        w.add('a', 2)
+        self.assertEqual(w.stats(2), (1.0, 0.0))
+        self.assertEqual(w.stats(5), (0.0, 0.0))
+
+    def test_bounds(self):
+        w = AdaptiveWindow(horizon=1)
+        w.add('a', 0)
+        self.assertEqual(w.window(5, 1, 5, 100, 0)[1], 2.5)
+        self.assertEqual(w.window(1, 1, 5, 100, 0)[1], 1)
+
+
+class TestAdaptiveHealer(unittest.TestCase):
+
+    def test_adapt(self):
+        th = TestHealer('test')
+        th.set_param('adaptive', 'true')
+        for _ in range(4):
+            th._adaptive_window.add(('CREATE', 'foo'), time.time())
+        th._adapt()
+        self.assertEqual(th.buffer_timeout, 5)
+        self.assertEqual(th._buffer.maxsize, th.buffer_size)
+        self.assertGreater(th.window['dup_ratio'], 0)
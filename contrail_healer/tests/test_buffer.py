@@ -1,8 +1,9 @@
 from __future__ import unicode_literals
+import time
 import gevent
 import unittest
 
-from ..healer import Healer
+from ..healer import Healer, Execution
 
 
 class TestHealer(Healer):
@@ -51,3 +52,114 @@ class TestBuffer(unittest.TestCase):
         self.assertEqual(len(th.checks), 0)
         gevent.sleep(2)
         self.assertEqual(len(th.checks), 1)
+
+
+class SlowHealer(TestHealer):
+    running = 0
+    max_running = 0
+
+    def check(self, oper, r):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        gevent.sleep(1)
+        self.running -= 1
+        return super(SlowHealer, self).check(oper, r)
+
+
+class TestInflight(unittest.TestCase):
+
+    def test_single_inflight_check(self):
+        th = SlowHealer('test')
+        th.set_param('buffer_size', 1)
+        th.checks = []
+        th.start()
+        th.queue.put(('CREATE', 'foo'))
+        gevent.sleep(0.5)
+        th.queue.put(('UPDATE', 'foo'))
+        gevent.sleep(0.3)
+        th.queue.put(('DELETE', 'foo'))
+        gevent.sleep(2.5)
+        self.assertEqual(th.max_running, 1)
+        self.assertEqual(th.checks, [('CREATE', 'foo'), ('DELETE', 'foo')])
+
+    def test_other_resources_not_blocked(self):
+        th = SlowHealer('test')
+        th.set_param('buffer_size', 1)
+        th.checks = []
+        th.start()
+        th.queue.put(('CREATE', 'foo'))
+        th.queue.put(('CREATE', 'bar'))
+        gevent.sleep(1.5)
+        self.assertEqual(len(th.checks), 2)
+
+
+class BatchHealer(TestHealer):
+    batches = []
+    failing = None
+
+    def check(self, oper, r):
+        self.checks.append((oper, r))
+        return (False, r)
+
+    def fix_many(self, fixes):
+        self.batches.append(fixes)
+        return [Exception() if args[0] == self.failing else args[0]
+                for args in fixes]
+
+
+class TestBatchFix(unittest.TestCase):
+
+    def test_fixes_batched(self):
+        th = BatchHealer('test')
+        th.set_param('buffer_size', 3)
+        th.checks = []
+        th.batches = []
+        th.start()
+        for r in ('foo', 'bar', 'baz'):
+            th.queue.put(('CREATE', r))
+        gevent.sleep(0.5)
+        self.assertEqual(len(th.batches), 1)
+        self.assertEqual(sorted(th.batches[0]), [('bar',), ('baz',), ('foo',)])
+
+    def test_failed_fix_retried(self):
+        th = BatchHealer('test')
+        th.set_param('buffer_size', 2)
+        th.buffer_timeout = 0.5
+        th.max_check_retries = 1
+        th.checks = []
+        th.batches = []
+        th.failing = 'foo'
+        th.start()
+        th.queue.put(('CREATE', 'foo'))
+        th.queue.put(('CREATE', 'bar'))
+        gevent.sleep(2.5)
+        self.assertEqual(th.checks.count(('CREATE', 'foo')), 2)
+        self.assertEqual(th.checks.count(('CREATE', 'bar')), 1)
+
+
+class ThreadHealer(TestHealer):
+    execution = Execution.THREAD
+    thread_pool_size = 2
+
+    def check(self, oper, r):
+        time.sleep(0.5)
+        return super(ThreadHealer, self).check(oper, r)
+
+
+class TestThreadExecution(unittest.TestCase):
+
+    def test_hub_not_blocked(self):
+        th = ThreadHealer('test')
+        th.set_param('buffer_size', 2)
+        th.checks = []
+        th.start()
+        ticks = []
+        g = gevent.spawn(lambda: [ticks.append(gevent.sleep(0.1)) for _ in range(8)])
+        th.queue.put(('CREATE', 'foo'))
+        th.queue.put(('CREATE', 'bar'))
+        gevent.sleep(0.9)
+        g.join()
+        self.assertEqual(len(th.checks), 2)
+        self.assertEqual(len(ticks), 8)
+        self.assertEqual(th.executor['tasks'], 2)
+        self.assertEqual(th.executor['pool_size'], 2)
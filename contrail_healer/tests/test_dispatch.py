@@ -0,0 +1,75 @@
+from __future__ import unicode_literals
+import unittest
+
+from ..dispatch import DispatchTable
+from ..healer import Operation
+
+
+class FakeHealer(object):
+
+    def __init__(self, resource, on, where=None, source=None):
+        self.resource = resource
+        self.on = on
+        self.where = where
+        self.source = source
+
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.table = DispatchTable()
+
+    def test_type_and_oper(self):
+        h = FakeHealer('floating-ip', Operation.CREATE)
+        self.table.add(h)
+        self.assertEqual(self.table.match({'type': 'floating-ip', 'oper': 'CREATE'}), [h])
+        self.assertEqual(self.table.match({'type': 'floating-ip', 'oper': 'DELETE'}), [])
+        self.assertEqual(self.table.match({'type': 'virtual-network', 'oper': 'CREATE'}), [])
+        self.assertEqual(self.table.match({'oper': 'CREATE'}), [])
+
+    def test_wildcard(self):
+        h = FakeHealer('*', Operation.DELETE)
+        self.table.add(h)
+        self.assertTrue(self.table.has_route('virtual-network', 'DELETE'))
+        self.assertEqual(self.table.match({'type': 'virtual-network', 'oper': 'DELETE'}), [h])
+
+    def test_value_predicates(self):
+        h1 = FakeHealer('floating-ip', Operation.CREATE,
+                        where={'obj_dict.fq_name': ['d', 'p', 'vn1', 'pool', 'fip'],
+                               'obj_dict.floating_ip_address': '1.1.1.1'})
+        h2 = FakeHealer('floating-ip', Operation.CREATE,
+                        where={'obj_dict.fq_name': ['d', 'p', 'vn2', 'pool', 'fip']})
+        self.table.add(h1)
+        self.table.add(h2)
+        body = {'type': 'floating-ip', 'oper': 'CREATE',
+                'obj_dict': {'fq_name': ['d', 'p', 'vn1', 'pool', 'fip'],
+                             'floating_ip_address': '1.1.1.1'}}
+        self.assertEqual(self.table.match(body), [h1])
+        body['obj_dict']['floating_ip_address'] = '1.1.1.2'
+        self.assertEqual(self.table.match(body), [])
+        del body['obj_dict']
+        self.assertEqual(self.table.match(body), [])
+
+    def test_callable_predicates(self):
+        h = FakeHealer('virtual-machine-interface', Operation.UPDATE,
+                       where={'obj_dict.virtual_machine_interface_device_owner':
+                              lambda owner: owner is not None and owner.startswith('network:')})
+        self.table.add(h)
+        body = {'type': 'virtual-machine-interface', 'oper': 'UPDATE',
+                'obj_dict': {'virtual_machine_interface_device_owner': 'network:router_interface'}}
+        self.assertEqual(self.table.match(body), [h])
+        body['obj_dict']['virtual_machine_interface_device_owner'] = 'compute:nova'
+        self.assertEqual(self.table.match(body), [])
+        del body['obj_dict']
+        self.assertEqual(self.table.match(body), [])
+
+    def test_source(self):
+        h1 = FakeHealer('floating-ip', Operation.CREATE, source='dc1')
+        h2 = FakeHealer('floating-ip', Operation.CREATE, source='dc2')
+        h3 = FakeHealer('floating-ip', Operation.CREATE)
+        for h in (h1, h2, h3):
+            self.table.add(h)
+        body = {'type': 'floating-ip', 'oper': 'CREATE', 'source': 'dc1'}
+        self.assertEqual(self.table.match(body), [h3, h1])
+        body['source'] = 'dc2'
+        self.assertEqual(self.table.match(body), [h3, h2])
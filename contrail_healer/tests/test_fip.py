@@ -0,0 +1,220 @@
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+from kazoo.exceptions import NoNodeError, NodeExistsError, RolledBackError, RuntimeInconsistency
+
+from netaddr import IPNetwork
+
+from contrail_api_cli.exceptions import CommandError
+
+from ..healer import Healer
+from ..healers import fip as fip_module
+from ..healers.fip import FIPHealer, sorted_addresses, difference, contains, registry
+
+
+class TestAuditHelpers(unittest.TestCase):
+
+    def test_sorted_addresses(self):
+        addresses = sorted_addresses(['10.0.0.3', '10.0.0.1', 167772162])
+        self.assertEqual(list(addresses), [167772161, 167772162, 167772163])
+
+    def test_difference(self):
+        a = sorted_addresses(['10.0.0.1', '10.0.0.2', '10.0.0.4'])
+        b = sorted_addresses(['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(list(difference(a, b)), [167772161, 167772164])
+        self.assertEqual(list(difference(b, a)), [167772163])
+        self.assertEqual(list(difference(a, [])), list(a))
+
+    def test_contains(self):
+        a = sorted_addresses(['10.0.0.1', '10.0.0.4'])
+        self.assertTrue(contains(a, 167772164))
+        self.assertFalse(contains(a, 167772162))
+
+    def test_ipv6_skipped(self):
+        addresses = sorted_addresses(['10.0.0.1', '2001:db8::1'])
+        self.assertEqual(list(addresses), [167772161])
+
+
+class FakeTransaction(object):
+
+    def __init__(self, zk):
+        self.zk = zk
+        self.creates = []
+
+    def create(self, path, value):
+        self.creates.append(path)
+
+    def commit(self):
+        self.zk.commits.append(list(self.creates))
+        results = []
+        failed = False
+        for path in self.creates:
+            if failed:
+                results.append(RuntimeInconsistency())
+                continue
+            if path in self.zk.nodes:
+                error = NodeExistsError()
+            elif path.rsplit('/', 1)[0] not in self.zk.nodes:
+                error = NoNodeError()
+            else:
+                results.append(path)
+                continue
+            # operations before the failing one are rolled back
+            results = [RolledBackError() for _ in results] + [error]
+            failed = True
+        if not failed:
+            self.zk.nodes.update(self.creates)
+        return results
+
+
+class FakeZk(object):
+
+    def __init__(self, nodes=()):
+        self.nodes = set(nodes)
+        self.commits = []
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def ensure_path(self, path):
+        self.nodes.add(path)
+
+    def get_children(self, path):
+        if path not in self.nodes:
+            raise NoNodeError()
+        return [n.rsplit('/', 1)[1] for n in self.nodes
+                if n.rsplit('/', 1)[0] == path]
+
+
+class FakeFIPHealer(FIPHealer):
+    config_file = None
+
+    def __init__(self, zk_client):
+        Healer.__init__(self, 'fip-healer')
+        self.zk_client = zk_client
+        self._zk_parents = set()
+
+
+class TestFixMany(unittest.TestCase):
+
+    def test_batches(self):
+        zk = FakeZk()
+        th = FakeFIPHealer(zk)
+        th.zk_batch_size = 2
+        fixes = [('/s/1', 'vn'), ('/s/2', 'vn'), ('/s/3', 'vn')]
+        self.assertEqual(th.fix_many(fixes), ['/s/1', '/s/2', '/s/3'])
+        self.assertEqual(zk.commits, [['/s/1', '/s/2'], ['/s/3']])
+
+    def test_rolled_back_retried(self):
+        zk = FakeZk(['/s', '/s/2'])
+        th = FakeFIPHealer(zk)
+        fixes = [('/s/1', 'vn'), ('/s/2', 'vn'), ('/s/3', 'vn')]
+        # /s/2 exists already, /s/1 and /s/3 are committed again
+        self.assertEqual(th.fix_many(fixes), ['/s/1', '/s/2', '/s/3'])
+        self.assertEqual(zk.commits, [['/s/1', '/s/2', '/s/3'], ['/s/1', '/s/3']])
+        self.assertTrue(set(['/s/1', '/s/3']) <= zk.nodes)
+
+    def test_parent_removed(self):
+        zk = FakeZk()
+        th = FakeFIPHealer(zk)
+        self.assertEqual(th.fix_many([('/s/1', 'vn')]), ['/s/1'])
+        zk.nodes = set()
+        results = th.fix_many([('/s/2', 'vn'), ('/t/1', 'vn')])
+        self.assertIsInstance(results[0], NoNodeError)
+        self.assertEqual(results[1], '/t/1')
+        # the parent is created again on the next fix
+        self.assertEqual(th.fix_many([('/s/2', 'vn')]), ['/s/2'])
+
+
+class FakeVN(dict):
+    uuid = 'vn-uuid'
+    fq_name = 'd:p:public'
+
+
+class FakeResource(dict):
+
+    def __init__(self, type, **kwargs):
+        super(FakeResource, self).__init__(kwargs)
+        self.type = type
+
+
+class AuditFIPHealer(FakeFIPHealer):
+
+    def __init__(self, zk_client, api):
+        super(AuditFIPHealer, self).__init__(zk_client)
+        self.api = api
+
+    def _fetch_vn(self):
+        self.vn = FakeVN(floating_ip_pools=[{'uuid': 'pool-uuid'}],
+                         network_ipam_refs=[{'attr': {'ipam_subnets': [
+                             {'default_gateway': '10.0.0.1'}, {}]}}])
+        self.subnets = [IPNetwork('10.0.0.0/24'), IPNetwork('2001:db8::/64')]
+
+    def _api_items(self, resource_type, field, **params):
+        return iter(self.api[resource_type])
+
+
+class TestAudit(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = fip_module.Resource
+        fip_module.Resource = FakeResource
+
+    def tearDown(self):
+        fip_module.Resource = self.resource
+
+    def test_audit(self):
+        zk = FakeZk()
+        api = {
+            'floating-ip': [
+                {'uuid': 'fip1', 'fq_name': ['d', 'p', 'public', 'pool', 'fip1'],
+                 'floating_ip_address': '10.0.0.10'},
+                {'uuid': 'fip2', 'fq_name': ['d', 'p', 'public', 'pool', 'fip2'],
+                 'floating_ip_address': '10.0.0.11'},
+                {'uuid': 'fip3', 'fq_name': ['d', 'p', 'public', 'pool', 'fip3'],
+                 'floating_ip_address': '2001:db8::5'},
+            ],
+            'instance-ip': [
+                {'uuid': 'iip1', 'instance_ip_address': '10.0.0.12'},
+            ],
+        }
+        th = AuditFIPHealer(zk, api)
+        th._fetch_vn()
+        path = th._zk_path_for_subnet(th.subnets[0])
+        zk.nodes.add(path)
+        # fip1, gateway, instance-ip and an orphaned allocation
+        for ip in ('10.0.0.10', '10.0.0.1', '10.0.0.12', '10.0.0.13'):
+            zk.nodes.add('%s/%i' % (path, int(IPNetwork(ip).ip)))
+        self.assertEqual(th.audit(), {'missing': 1, 'orphaned': 1})
+        self.assertEqual(th.queue.qsize(), 1)
+        oper, fip = th.queue.get()
+        self.assertEqual(oper, 'CREATE')
+        self.assertEqual(fip['uuid'], 'fip2')
+
+
+class TestSource(unittest.TestCase):
+
+    def setUp(self):
+        self.sources = registry.sources
+        self.old_home = os.environ.get('HOME')
+        self.home = tempfile.mkdtemp()
+        os.environ['HOME'] = self.home
+        os.makedirs(os.path.join(self.home, '.config', 'contrail-healer'))
+        path = os.path.join(self.home, '.config', 'contrail-healer', 'fip-healer.conf')
+        with open(path, 'w') as f:
+            f.write('[default]\nzk_server = zk:2181\npublic_vn_fqname = d:p:public\n')
+
+    def tearDown(self):
+        registry.sources = self.sources
+        if self.old_home is not None:
+            os.environ['HOME'] = self.old_home
+        shutil.rmtree(self.home)
+
+    def test_source_required(self):
+        registry.sources = ['dc1', 'dc2']
+        self.assertRaises(CommandError, FIPHealer, 'fip-healer')
+        # no ZooKeeper client is left behind
+        self.assertEqual(registry.stats()['zk'], {})
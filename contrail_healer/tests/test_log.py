@@ -0,0 +1,79 @@
+from __future__ import unicode_literals
+import io
+import logging
+import unittest
+
+from .test_buffer import TestHealer
+from ..healer import logger
+from ..log import AsyncStreamHandler
+
+
+class Rendered(object):
+    count = 0
+
+    def __str__(self):
+        Rendered.count += 1
+        return 'rendered'
+
+
+class TestLazyLog(unittest.TestCase):
+
+    def test_debug_not_rendered(self):
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            th = TestHealer('test')
+            Rendered.count = 0
+            th.log_debug("got %s", Rendered(), oper='CREATE', resource='foo')
+            self.assertEqual(Rendered.count, 0)
+        finally:
+            logger.setLevel(level)
+
+
+class DelayedHandler(AsyncStreamHandler):
+    started = False
+
+    def _start(self):
+        if self.started:
+            super(DelayedHandler, self)._start()
+
+
+class TestAsyncStreamHandler(unittest.TestCase):
+
+    def test_write(self):
+        stream = io.StringIO()
+        handler = AsyncStreamHandler(stream)
+        log = logging.getLogger('contrail_healer.tests.async')
+        log.propagate = False
+        log.addHandler(handler)
+        log.warning("foo %s", "bar")
+        handler.close()
+        log.removeHandler(handler)
+        self.assertEqual(stream.getvalue(), "foo bar\n")
+
+    def test_formatted_when_emitted(self):
+        stream = io.StringIO()
+        handler = AsyncStreamHandler(stream)
+        log = logging.getLogger('contrail_healer.tests.async')
+        log.propagate = False
+        log.addHandler(handler)
+        value = ['foo']
+        log.warning("value %s", value)
+        value.append('bar')
+        handler.close()
+        log.removeHandler(handler)
+        self.assertEqual(stream.getvalue(), "value [%r]\n" % 'foo')
+
+    def test_dropped_reported(self):
+        stream = io.StringIO()
+        handler = DelayedHandler(stream, maxsize=1)
+        log = logging.getLogger('contrail_healer.tests.async')
+        log.propagate = False
+        log.addHandler(handler)
+        for _ in range(3):
+            log.warning("foo")
+        handler.started = True
+        handler._start()
+        handler.close()
+        log.removeHandler(handler)
+        self.assertEqual(stream.getvalue(), "foo\n2 log records dropped\n")
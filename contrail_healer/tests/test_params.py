@@ -0,0 +1,125 @@
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import gevent
+import unittest
+
+from contrail_api_cli.exceptions import CommandError
+
+from .test_buffer import TestHealer
+from ..control import ControlServer
+
+
+class ConfigHealer(TestHealer):
+    config_file = 'test-healer.conf'
+
+
+class TestParams(unittest.TestCase):
+
+    def test_set_param(self):
+        th = TestHealer('test')
+        th.set_param('buffer_timeout', '2.5')
+        th.set_param('max_check_retries', '5')
+        self.assertEqual(th.buffer_timeout, 2.5)
+        self.assertEqual(th.max_check_retries, 5)
+
+    def test_set_invalid_param(self):
+        th = TestHealer('test')
+        self.assertRaises(ValueError, th.set_param, 'foo', 1)
+        self.assertRaises(ValueError, th.set_param, 'buffer_size', 'foo')
+        self.assertRaises(ValueError, th.set_param, 'buffer_size', 0)
+        self.assertRaises(ValueError, th.set_param, 'check_delay', -1)
+
+    def test_resize_buffer(self):
+        th = TestHealer('test')
+        th.buffer_timeout = 10
+        th.checks = []
+        th.start()
+        for r in ('foo', 'bar', 'baz'):
+            th.queue.put(('CREATE', r))
+        gevent.sleep(0.5)
+        self.assertEqual(th.checks, [])
+        th.set_param('buffer_size', 1)
+        gevent.sleep(0.5)
+        self.assertEqual(sorted(th.checks),
+                         [('CREATE', 'bar'), ('CREATE', 'baz'), ('CREATE', 'foo')])
+
+    def test_resize_paused(self):
+        th = TestHealer('test')
+        th.buffer_timeout = 10
+        th.checks = []
+        th.start()
+        th.pause()
+        for r in ('foo', 'bar', 'baz'):
+            th.queue.put(('CREATE', r))
+        gevent.sleep(0.5)
+        th.set_param('buffer_size', 1)
+        gevent.sleep(0.5)
+        self.assertEqual(th.checks, [])
+        th.resume()
+        gevent.sleep(0.5)
+        self.assertEqual(len(th.checks), 3)
+
+    def test_reload_invalid_config(self):
+        home = tempfile.mkdtemp()
+        old_home = os.environ.get('HOME')
+        os.environ['HOME'] = home
+        try:
+            os.makedirs(os.path.join(home, '.config', 'contrail-healer'))
+            path = os.path.join(home, '.config', 'contrail-healer', 'test-healer.conf')
+            with open(path, 'w') as f:
+                f.write('[default]\nbuffer_timeout = 1\n')
+            th = ConfigHealer('test')
+            self.assertEqual(th.buffer_timeout, 1)
+            with open(path, 'w') as f:
+                f.write('[default]\nbuffer_timeout = 2\nbuffer_size = 0\n')
+            self.assertRaises(CommandError, th.reload_config)
+            self.assertEqual(th.buffer_timeout, 1)
+        finally:
+            if old_home is not None:
+                os.environ['HOME'] = old_home
+            shutil.rmtree(home)
+
+    def test_pause_drain(self):
+        th = TestHealer('test')
+        th.buffer_timeout = 0.2
+        th.checks = []
+        th.start()
+        th.pause()
+        th.queue.put(('CREATE', 'foo'))
+        th.queue.put(('CREATE', 'bar'))
+        gevent.sleep(0.5)
+        self.assertEqual(th.checks, [])
+        th.drain()
+        gevent.sleep(0.1)
+        self.assertEqual(len(th.checks), 2)
+        th.resume()
+        th.queue.put(('CREATE', 'baz'))
+        gevent.sleep(0.5)
+        self.assertEqual(len(th.checks), 3)
+
+
+class TestControl(unittest.TestCase):
+
+    def setUp(self):
+        self.th = TestHealer('test')
+        self.control = ControlServer('/nonexistent', {'test': self.th})
+
+    def test_set(self):
+        res = self.control.execute('set test buffer_size 20')
+        self.assertEqual(res['result']['buffer_size'], 20)
+        self.assertEqual(self.th._buffer.maxsize, 20)
+
+    def test_errors(self):
+        self.assertIn('error', self.control.execute('set foo buffer_size 20'))
+        self.assertIn('error', self.control.execute('set test buffer_size foo'))
+        self.assertIn('error', self.control.execute('set test'))
+        self.assertIn('error', self.control.execute('foo'))
+
+    def test_pause(self):
+        self.control.execute('pause test')
+        self.assertTrue(self.th.paused)
+        self.assertTrue(self.control.execute('list')['result']['test']['paused'])
+        self.control.execute('resume test')
+        self.assertFalse(self.th.paused)
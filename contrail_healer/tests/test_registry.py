@@ -0,0 +1,100 @@
+from __future__ import unicode_literals
+import time
+import unittest
+
+import gevent
+
+from .. import registry as registry_module
+from ..registry import Registry
+
+
+class FakeZkClient(object):
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.closed = False
+
+    def stop(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+# clients built by HangingKazooClient
+clients = []
+
+
+class HangingKazooClient(FakeZkClient):
+
+    def __init__(self, hosts, **kwargs):
+        super(HangingKazooClient, self).__init__(hosts)
+        self.stopped = False
+        clients.append(self)
+
+    def start(self):
+        gevent.sleep(10)
+
+    def stop(self):
+        self.stopped = True
+
+
+class TestRegistry(Registry):
+
+    def _make_zk_client(self, hosts):
+        return FakeZkClient(hosts)
+
+
+class SlowRegistry(TestRegistry):
+
+    def _make_zk_client(self, hosts):
+        gevent.sleep(0.3)
+        return super(SlowRegistry, self)._make_zk_client(hosts)
+
+
+class TestZkClients(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = TestRegistry()
+        self.registry.close()
+
+    def test_shared_client(self):
+        c1 = self.registry.zk_client('foo:2181')
+        c2 = self.registry.zk_client('foo:2181')
+        c3 = self.registry.zk_client('bar:2181')
+        self.assertIs(c1, c2)
+        self.assertIsNot(c1, c3)
+        self.assertEqual(self.registry.stats()['zk'],
+                         {'foo:2181': 2, 'bar:2181': 1})
+
+    def test_release_client(self):
+        c = self.registry.zk_client('foo:2181')
+        self.registry.zk_client('foo:2181')
+        self.registry.release_zk_client('foo:2181')
+        self.assertFalse(c.closed)
+        self.registry.release_zk_client('foo:2181')
+        self.assertTrue(c.closed)
+        self.assertEqual(self.registry.stats()['zk'], {})
+
+    def test_concurrent_connect(self):
+        registry = SlowRegistry()
+        registry.close()
+        start = time.time()
+        g = [gevent.spawn(registry.zk_client, hosts)
+             for hosts in ('foo:2181', 'bar:2181', 'foo:2181')]
+        gevent.joinall(g)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertIs(g[0].value, g[2].value)
+        self.assertEqual(registry.stats()['zk'],
+                         {'foo:2181': 2, 'bar:2181': 1})
+
+    def test_interrupted_connect(self):
+        orig = registry_module.KazooClient
+        registry_module.KazooClient = HangingKazooClient
+        try:
+            with gevent.Timeout(0.1, False):
+                Registry()._make_zk_client('foo:2181')
+        finally:
+            registry_module.KazooClient = orig
+        self.assertTrue(clients[-1].stopped)
+        self.assertTrue(clients[-1].closed)
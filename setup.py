@@ -4,6 +4,8 @@ install_requires = [
     'contrail-api-cli',
     'kombu',
     'kazoo',
+    'requests',
+    'stevedore',
 ]
 
 test_requires = []